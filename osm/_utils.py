@@ -1,46 +1,83 @@
 import argparse
+import atexit
 import datetime
+import functools
+import hashlib
 import logging
 import os
 import re
 import time
-import types
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+from typing import TextIO
 
 import pandas as pd
 import requests
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+from requests.adapters import HTTPAdapter
 
 DEFAULT_OUTPUT_DIR = "./osm_output"
+# Seconds to wait for docker compose up to return once rtransparent is healthy,
+# which may include pulling the images if it was already running.
+COMPOSE_UP_TIMEOUT = 600
 logger = logging.getLogger(__name__)
 
 ERROR_CSV_PATH = Path("error_log.csv")
 ERROR_LOG_PATH = Path("error.log")
 
 
-def write_error_to_file(row: pd.Series, error: Exception):
-    with ERROR_CSV_PATH.open("a") as csv_file, ERROR_LOG_PATH.open("a") as log_file:
-        # Write the problematic row data to the CSV, add header if not yet populated.
-        row.to_csv(
-            csv_file,
-            header=not ERROR_CSV_PATH.exists() or ERROR_CSV_PATH.stat().st_size == 0,
-            index=False,
-        )
+_error_files = None
+_error_csv_header_written = False
+
+
+def _get_error_files() -> tuple[TextIO, TextIO]:
+    """Open the error csv and log files once, in append mode, and keep them open."""
+    global _error_files, _error_csv_header_written
+    if _error_files is None:
+        csv_file = ERROR_CSV_PATH.open("a")
+        try:
+            log_file = ERROR_LOG_PATH.open("a")
+        except Exception:
+            csv_file.close()
+            raise
+        _error_csv_header_written = csv_file.tell() > 0
+        _error_files = (csv_file, log_file)
+        atexit.register(_close_error_files)
+    return _error_files
 
-        # Drop string values as they tend to be too long
-        display_row = (
-            row.apply(lambda x: x if not isinstance(x, str) else None)
-            .dropna()
-            .to_dict()
-        )
-        log_file.write(f"Error processing data:\n {display_row}\nError: {error}\n\n")
 
+def _close_error_files() -> None:
+    global _error_files
+    if _error_files is not None:
+        for f in _error_files:
+            f.close()
+        _error_files = None
 
+
+def write_error_to_file(row: pd.Series, error: Exception):
+    global _error_csv_header_written
+    csv_file, log_file = _get_error_files()
+    # Write the problematic row data to the CSV, add header if not yet populated.
+    row.to_csv(csv_file, header=not _error_csv_header_written, index=False)
+    _error_csv_header_written = True
+
+    # Drop string values as they tend to be too long
+    display_row = (
+        row.apply(lambda x: x if not isinstance(x, str) else None).dropna().to_dict()
+    )
+    log_file.write(f"Error processing data:\n {display_row}\nError: {error}\n\n")
+    csv_file.flush()
+    log_file.flush()
+
+
+@functools.lru_cache(maxsize=16)
 def _get_metrics_dir(output_dir: Path = DEFAULT_OUTPUT_DIR) -> Path:
     metrics_dir = Path(output_dir) / "metrics"
     metrics_dir.mkdir(parents=True, exist_ok=True)
     return metrics_dir
 
 
+@functools.lru_cache(maxsize=16)
 def _get_text_dir(output_dir: Path = DEFAULT_OUTPUT_DIR) -> Path:
     text_dir = Path(output_dir) / "pdf_texts"
     text_dir.mkdir(parents=True, exist_ok=True)
@@ -60,33 +97,71 @@ def _existing_file(path_string):
     return path
 
 
-def get_compute_context_id():
-    return hash(f"{os.environ.get('HOSTNAME')}_{os.environ.get('USERNAME')}")
-
-
-def wait_for_containers():
+def get_compute_context_id() -> int:
+    """
+    Stable identifier of the host and user, unlike hash() which is salted
+    per process. Signed so that it fits in a BSON int64.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    h.update((os.environ.get("HOSTNAME") or "").encode())
+    h.update(b"\x00")
+    h.update((os.environ.get("USERNAME") or "").encode())
+    return int.from_bytes(h.digest(), "big", signed=True)
+
+
+def wait_for_containers(
+    url: str = "http://localhost:8071/health",
+    initial_delay: float = 0.05,
+    max_delay: float = 1.0,
+    compose: Future | None = None,
+    timeout: float = 120.0,
+):
     """
     A hack for now, on Apple Silicon, the parser container fails. Ideally we
     would just use the wait kwargs for docker compose up
-    """
-    while True:
-        try:
-            response = requests.get("http://localhost:8071/health")
-            if response.status_code == 200:
-                break
-        except requests.exceptions.RequestException:
-            pass
-
-        time.sleep(1)
 
+    Polls the health endpoint over a single pooled connection, backing off
+    exponentially from initial_delay up to max_delay between attempts.
 
-def compose_up():
+    If the future of a running compose_up is given, its error (if any) is
+    raised, and the timeout only starts once compose has returned, so that
+    pulling the images doesn't count towards it.
+    """
+    deadline = None if compose is not None else time.monotonic() + timeout
+    with requests.Session() as session:
+        session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        delay = initial_delay
+        while True:
+            try:
+                response = session.get(url, timeout=0.5)
+                if response.status_code == 200:
+                    break
+            except requests.exceptions.RequestException:
+                pass
+
+            if deadline is None and compose.done():
+                compose.result()
+                deadline = time.monotonic() + timeout
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"{url} still unhealthy after {timeout}s")
+
+            time.sleep(delay)
+            delay = min(max_delay, delay * 2)
+
+
+def compose_up() -> Future:
+    """
+    Starts the docker compose services from a background thread, so that the
+    caller can poll for them to be ready while compose is still pulling and
+    starting them (see wait_for_containers). The returned future completes
+    once all the services are running, and raises any error from compose.
+    """
     from python_on_whales import docker
 
-    logger.info("Waiting for containers to be ready...")
-    print("Waiting for containers to be ready...")
-    docker.compose.up(detach=True, wait=True, pull="always")
-    print("Containers ready!")
+    executor = ThreadPoolExecutor(max_workers=1)
+    compose = executor.submit(docker.compose.up, detach=True, wait=True, pull="always")
+    executor.shutdown(wait=False)
+    return compose
 
 
 def compose_down():
@@ -147,38 +222,79 @@ def _setup(args):
     # create logs directory if necessary
     _ = _get_logs_dir()
     if not args.user_managed_compose:
-        compose_up()
+        compose = compose_up()
+        logger.info("Waiting for containers to be ready...")
+        print("Waiting for containers to be ready...")
+        wait_for_containers(compose=compose)
+        # rtransparent is up, compose returns once the other services are too
+        compose.result(timeout=COMPOSE_UP_TIMEOUT)
+        print("Containers ready!")
     return xml_path, metrics_path
 
 
 def coerce_to_string(v):
     "Can be useful for schemas with permissive string fields"
-    if isinstance(v, (int, float, bool)):
-        return str(v)
-    elif isinstance(v, types.NoneType):
+    # Cheap identity and type checks first, pd.isna is only needed for the
+    # less common missing values (pd.NA, NaT...)
+    if v is None:
         return None
+    elif isinstance(v, str):
+        return v
+    elif isinstance(v, (int, float, bool)):
+        # NaN is the only value not equal to itself
+        return str(v) if v == v else None
+    elif isinstance(v, pd.Series):
+        return coerce_series_to_string(v)
     elif pd.isna(v):
         return None
-    elif not isinstance(v, str):
-        raise ValueError("string required or a type that can be coerced to a string")
-    return v
+    raise ValueError("string required or a type that can be coerced to a string")
+
+
+def coerce_series_to_string(s: pd.Series) -> pd.Series:
+    """
+    Vectorized version of coerce_to_string for a whole column.
+
+    :param s: Series to coerce.
+    :return: Object Series of strings, with missing values set to None.
+    """
+    missing = s.isna()
+    if not (is_numeric_dtype(s) or is_bool_dtype(s)):
+        present = s[~missing]
+        # Exact str is the common case and much cheaper to check than isinstance
+        is_str = present.map(type).eq(str)
+        if not is_str.all():
+            others = present[~is_str]
+            if not others.map(lambda x: isinstance(x, (str, int, float, bool))).all():
+                raise ValueError(
+                    "string required or a type that can be coerced to a string"
+                )
+    return s.astype(str).astype(object).where(~missing, None)
 
 
 def flatten_dict(d):
     """
-    Recursively flattens a nested dictionary without prepending parent keys.
+    Flattens a nested dictionary without prepending parent keys.
+
+    Walks the nested dictionaries depth-first with an explicit stack of
+    iterators rather than recursion, so keys keep the order (and later keys
+    the precedence) they would have in a recursive traversal.
 
     :param d: Dictionary to flatten.
     :return: Flattened dictionary.
     """
-    items = []
-    for k, v in d.items():
-        if isinstance(v, dict):
-            # If the value is a dictionary, flatten it without the parent key
-            items.extend(flatten_dict(v).items())
+    flat = {}
+    set_item = flat.__setitem__
+    stack = [iter(d.items())]
+    while stack:
+        for k, v in stack[-1]:
+            if isinstance(v, dict):
+                # Descend into the nested dictionary without the parent key
+                stack.append(iter(v.items()))
+                break
+            set_item(k, v)
         else:
-            items.append((k, v))
-    return dict(items)
+            stack.pop()
+    return flat
 
 
 def camel_to_snake(name: str) -> str:
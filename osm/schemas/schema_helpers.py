@@ -227,10 +227,13 @@ def infer_type_for_column(column):
         return pa.string()
 
 
-def matches_to_table(matches: Iterator[dict], batch_size: int = 1000) -> pa.Table:
-    # Initialize an empty list to store batches of tables
-    tables = []
-
+def matches_to_tables(
+    matches: Iterator[dict], batch_size: int = 1000
+) -> Iterator[pa.Table]:
+    """
+    Converts the matches to tables of batch_size rows, one batch at a time,
+    so that they can be written out without holding all of them in memory.
+    """
     # Process the generator in batches
     while True:
         # Collect the next batch of rows
@@ -263,8 +266,11 @@ def matches_to_table(matches: Iterator[dict], batch_size: int = 1000) -> pa.Tabl
         # Convert DataFrame to PyArrow Table with the extended schema
         table = pa.Table.from_pandas(df, schema=adjusted_schema, safe=False)
 
-        # Append the table to the list
-        tables.append(table)
+        yield table
+
+
+def matches_to_table(matches: Iterator[dict], batch_size: int = 1000) -> pa.Table:
+    tables = list(matches_to_tables(matches, batch_size))
 
     if not tables:
         raise ValueError("Matches generator is empty")
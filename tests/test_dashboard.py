@@ -0,0 +1,120 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+# The dashboard needs the optional plot dependencies, and its modules import
+# each other as top-level modules, as when run from web/dashboard.
+pytest.importorskip("panel")
+pytest.importorskip("colorcet")
+sys.path.insert(0, str(Path(__file__).parents[1] / "web" / "dashboard"))
+
+from app import clean_list_column, write_parquet  # noqa: E402
+from main_dashboard import (  # noqa: E402
+    flatten_list_column,
+    list_column_mask,
+    merge_echarts_config,
+)
+
+
+@pytest.mark.parametrize(
+    "cell,expected",
+    [
+        ([], ["None"]),
+        ([""], ["None"]),
+        (None, ["None"]),
+        ([" "], [""]),
+        (["", "x"], ["", "x"]),
+        (["NIH", " NIH ", "NIH"], ["NIH"]),
+        (["C2", "C1"], ["C1", "C2"]),
+    ],
+)
+def test_clean_list_column(cell, expected):
+    col = pa.chunked_array([pa.array([cell], pa.list_(pa.string()))])
+    assert clean_list_column(col).to_pylist() == [expected]
+
+
+def test_clean_list_column_rows():
+    col = pa.chunked_array(
+        [
+            pa.array([["b", "a", "b"], None], pa.list_(pa.string())),
+            pa.array([[], [" x"], [""]], pa.list_(pa.string())),
+        ]
+    )
+    assert clean_list_column(col).to_pylist() == [
+        ["a", "b"],
+        ["None"],
+        ["None"],
+        ["x"],
+        ["None"],
+    ]
+
+
+def test_flatten_list_column():
+    col = pd.Series([("a", "b"), (), ("",), ("", "b"), ("b",)])
+    rows, codes, uniques = flatten_list_column(col)
+    # Empty cells and cells holding a single blank value become "None"
+    assert rows.tolist() == [0, 0, 1, 2, 3, 3, 4]
+    assert uniques[codes].tolist() == ["a", "b", "None", "None", "", "b", "b"]
+
+
+@pytest.mark.parametrize(
+    "selected,expected",
+    [
+        ({"a"}, [True, False, False, False]),
+        ({"b", "None"}, [True, True, False, True]),
+        ({"None"}, [False, True, False, True]),
+        ({"missing"}, [False, False, False, False]),
+        (set(), [False, False, False, False]),
+    ],
+)
+def test_list_column_mask(selected, expected):
+    # The last rows are empty, to check that the mask covers them
+    col = pd.Series([("a", "b"), ("None", "b"), ("c",), ()])
+    mask = list_column_mask(flatten_list_column(col), selected)
+    assert mask.dtype == np.bool_
+    assert mask.tolist() == expected
+
+
+def test_list_column_mask_empty_column():
+    col = pd.Series([], dtype=object)
+    assert list_column_mask(flatten_list_column(col), {"a"}).tolist() == []
+
+
+def test_merge_echarts_config():
+    base = {"grid": {"width": "800"}, "xAxis": {"name": "year", "nameGap": 40}}
+    update = {"xAxis": {"data": [2000]}, "series": [{"data": [1]}]}
+    merged = merge_echarts_config(base, update)
+    assert merged == {
+        "grid": {"width": "800"},
+        "xAxis": {"name": "year", "nameGap": 40, "data": [2000]},
+        "series": [{"data": [1]}],
+    }
+    # The base config is left untouched
+    assert base["xAxis"] == {"name": "year", "nameGap": 40}
+
+
+def test_write_parquet(tmp_path):
+    path = tmp_path / "matches.parquet"
+    tables = [pa.table({"year": [2000, 2001]}), pa.table({"year": [2002]})]
+    write_parquet(iter(tables), str(path), row_group_size=2)
+    assert pq.read_table(path)["year"].to_pylist() == [2000, 2001, 2002]
+    assert pq.ParquetFile(path).metadata.num_row_groups == 2
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_write_parquet_failure(tmp_path):
+    path = tmp_path / "matches.parquet"
+
+    def tables():
+        yield pa.table({"year": [2000]})
+        raise RuntimeError("connection lost")
+
+    with pytest.raises(RuntimeError):
+        write_parquet(tables(), str(path))
+    # No partial file is left to be mistaken for the complete data
+    assert list(tmp_path.iterdir()) == []
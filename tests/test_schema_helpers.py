@@ -62,3 +62,17 @@ def test_transform_data():
 
 # Run the test
 test_transform_data()
+
+
+def test_matches_to_tables():
+    matches = [
+        {"_id": i, "pmid": i, "year": 2000 + i, "is_open_data": i % 2 == 0}
+        for i in range(5)
+    ]
+    tables = list(osh.matches_to_tables(iter(matches), batch_size=2))
+    assert [t.num_rows for t in tables] == [2, 2, 1]
+    assert "_id" not in tables[0].column_names
+
+    table = osh.matches_to_table(iter(matches), batch_size=2)
+    assert table.equals(pa.concat_tables(tables))
+    assert table["pmid"].to_pylist() == list(range(5))
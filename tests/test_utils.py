@@ -0,0 +1,174 @@
+from concurrent.futures import Future
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+
+from osm import _utils
+from osm._utils import (
+    _close_error_files,
+    _get_error_files,
+    _get_metrics_dir,
+    coerce_series_to_string,
+    coerce_to_string,
+    flatten_dict,
+    get_compute_context_id,
+    wait_for_containers,
+    write_error_to_file,
+)
+
+
+def test_coerce_series_to_string_object():
+    s = pd.Series(["a", None, 1, 2.5, True, pd.NA], dtype=object)
+    expected = ["a", None, "1", "2.5", "True", None]
+    assert coerce_series_to_string(s).tolist() == expected
+    assert coerce_to_string(s).tolist() == expected
+
+
+def test_coerce_series_to_string_str_subclass():
+    s = pd.Series([np.str_("x"), "y"], dtype=object)
+    assert coerce_series_to_string(s).tolist() == ["x", "y"]
+    assert coerce_to_string(np.str_("x")) == "x"
+
+
+def test_coerce_series_to_string_numeric():
+    s = pd.Series([123, pd.NA, 456], dtype="Int64")
+    assert coerce_series_to_string(s).tolist() == ["123", None, "456"]
+
+
+def test_coerce_series_to_string_invalid():
+    with pytest.raises(ValueError):
+        coerce_series_to_string(pd.Series(["a", ["b"]], dtype=object))
+
+
+def test_flatten_dict():
+    nested = {"a": 1, "b": {"c": 2, "d": {"e": 3}, "a": 4}, "f": {}, "g": 5}
+    assert list(flatten_dict(nested).items()) == [
+        ("a", 4),
+        ("c", 2),
+        ("e", 3),
+        ("g", 5),
+    ]
+
+
+def test_get_metrics_dir_is_cached(tmp_path):
+    metrics_dir = _get_metrics_dir(tmp_path)
+    assert metrics_dir == tmp_path / "metrics"
+    assert metrics_dir.is_dir()
+    assert _get_metrics_dir(tmp_path) is metrics_dir
+
+
+def test_get_compute_context_id_is_stable(monkeypatch):
+    monkeypatch.setenv("HOSTNAME", "host")
+    monkeypatch.setenv("USERNAME", "user")
+    context_id = get_compute_context_id()
+    assert context_id == get_compute_context_id()
+    assert -(2**63) <= context_id < 2**63
+    monkeypatch.setenv("USERNAME", "other")
+    assert get_compute_context_id() != context_id
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("a", "a"),
+        (1, "1"),
+        (2.5, "2.5"),
+        (True, "True"),
+        (None, None),
+        (float("nan"), None),
+        (pd.NA, None),
+        (pd.NaT, None),
+    ],
+)
+def test_coerce_to_string_scalar(value, expected):
+    assert coerce_to_string(value) == expected
+
+
+def test_coerce_to_string_invalid():
+    with pytest.raises(ValueError):
+        coerce_to_string(["a"])
+
+
+@pytest.fixture
+def error_paths(tmp_path, monkeypatch):
+    monkeypatch.setattr(_utils, "ERROR_CSV_PATH", tmp_path / "error_log.csv")
+    monkeypatch.setattr(_utils, "ERROR_LOG_PATH", tmp_path / "error.log")
+    monkeypatch.setattr(_utils, "_error_files", None)
+    monkeypatch.setattr(_utils, "_error_csv_header_written", False)
+    yield _utils.ERROR_CSV_PATH, _utils.ERROR_LOG_PATH
+    _close_error_files()
+
+
+def test_write_error_to_file_appends(error_paths):
+    csv_path, log_path = error_paths
+    write_error_to_file(pd.Series({"a": 1}), ValueError("first"))
+    write_error_to_file(pd.Series({"a": 2}), ValueError("second"))
+    assert csv_path.read_text().splitlines() == ["0", "1", "2"]
+    log = log_path.read_text()
+    assert "Error: first" in log and "Error: second" in log
+
+
+def test_write_error_to_file_existing_csv(error_paths):
+    csv_path, _ = error_paths
+    csv_path.write_text("0\n1\n")
+    write_error_to_file(pd.Series({"a": 2}), ValueError("error"))
+    assert csv_path.read_text().splitlines() == ["0", "1", "2"]
+
+
+def test_get_error_files_closes_csv_on_failure(error_paths, monkeypatch):
+    csv_file = mock.MagicMock()
+    monkeypatch.setattr(
+        _utils, "ERROR_CSV_PATH", mock.Mock(open=mock.Mock(return_value=csv_file))
+    )
+    monkeypatch.setattr(
+        _utils, "ERROR_LOG_PATH", mock.Mock(open=mock.Mock(side_effect=OSError))
+    )
+    with pytest.raises(OSError):
+        _get_error_files()
+    csv_file.close.assert_called_once()
+    assert _utils._error_files is None
+
+
+@pytest.fixture
+def health_session(monkeypatch):
+    session = mock.MagicMock()
+    session.__enter__.return_value = session
+    monkeypatch.setattr(_utils.requests, "Session", mock.Mock(return_value=session))
+    monkeypatch.setattr(_utils.time, "sleep", mock.Mock())
+    return session
+
+
+def test_wait_for_containers_ready(health_session):
+    health_session.get.side_effect = [
+        requests.exceptions.ConnectionError(),
+        mock.Mock(status_code=503),
+        mock.Mock(status_code=200),
+    ]
+    # The timeout only starts once compose has returned
+    wait_for_containers(compose=Future(), timeout=0)
+    assert health_session.get.call_count == 3
+
+
+def test_wait_for_containers_compose_error(health_session):
+    health_session.get.return_value = mock.Mock(status_code=503)
+    compose = Future()
+    compose.set_exception(RuntimeError("compose failed"))
+    with pytest.raises(RuntimeError, match="compose failed"):
+        wait_for_containers(compose=compose)
+
+
+def test_wait_for_containers_timeout_after_compose(health_session):
+    health_session.get.return_value = mock.Mock(status_code=503)
+    compose = Future()
+    compose.set_result(None)
+    with pytest.raises(TimeoutError):
+        wait_for_containers(compose=compose, timeout=0)
+
+
+def test_wait_for_containers_timeout_without_compose(health_session):
+    health_session.get.side_effect = requests.exceptions.ConnectionError()
+    with pytest.raises(TimeoutError):
+        wait_for_containers(timeout=0)
@@ -1,6 +1,9 @@
 import os
+from collections.abc import Iterable
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
 import panel as pn
 import param
 import pyarrow as pa
@@ -9,19 +12,187 @@ import pyarrow.parquet as pq
 import ui
 from main_dashboard import MainDashboard
 from pyarrow import compute as pc
+from pyarrow import feather
 
 from osm.schemas import schema_helpers as osh
 
+# Columns of the matches used by the dashboard
+DATA_COLUMNS = [
+    "year",
+    "journal",
+    "affiliation_country",
+    "funder",
+    "data_tags",
+    "is_open_data",
+    "is_open_code",
+]
 
-def load_data():
+DATA_FILTER = (ds.field("year") >= 2000) & (
+    # Filter out some distracting weird data
+    (
+        ds.field("journal")
+        != "Acta Crystallographica Section E: Structure Reports Online"
+    )
+    | ds.field("journal").is_null()
+)
+
+
+# Bump whenever load_data changes the processed output,
+# so that snapshots written by an earlier version are not read.
+PROCESSED_DATA_VERSION = 3
+
+
+def processed_data_path(local_path: str | None) -> Path | None:
+    """
+    Path of the post-processed snapshot stored next to the local parquet data.
+    The format version is part of the file name.
+    """
+    if local_path is None:
+        return None
+    return Path(local_path).with_suffix(f".v{PROCESSED_DATA_VERSION}.feather")
+
+
+def clean_list_column(col: pa.ChunkedArray) -> pa.ListArray:
+    """
+    Removes duplicates and leading and trailing spaces in the values of a list
+    column, and replaces empty lists (or lists holding a single empty string)
+    with ["None"] to simplify the filtering and grouping in the dashboard.
+    Values come out sorted, so cells holding the same values in a different
+    order fall in the same group.
+    """
+    arr = col.combine_chunks()
+    lengths = pc.fill_null(pc.list_value_length(arr), 0).to_numpy()
+    values = pc.list_flatten(arr)
+    rows = pc.list_parent_indices(arr).to_numpy()
+
+    is_none = lengths == 0
+    is_blank = pc.fill_null(pc.equal(values, ""), False).to_numpy(zero_copy_only=False)
+    is_none[rows[is_blank & (lengths[rows] == 1)]] = True
+
+    # Unique (row, value) pairs, with the "None" rows swapped in
+    keep = ~is_none[rows]
+    none_rows = np.flatnonzero(is_none)
+    pairs = pa.concat_tables(
+        [
+            pa.table(
+                {
+                    "row": rows[keep],
+                    "value": pc.utf8_trim_whitespace(values.filter(keep)),
+                }
+            )
+            .group_by(["row", "value"], use_threads=False)
+            .aggregate([]),
+            pa.table(
+                {
+                    "row": none_rows,
+                    "value": pa.array(["None"] * len(none_rows), pa.string()),
+                }
+            ),
+        ]
+    ).sort_by([("row", "ascending"), ("value", "ascending")])
+
+    counts = np.bincount(pairs["row"].to_numpy(), minlength=len(arr))
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int32)
+    return pa.ListArray.from_arrays(offsets, pairs["value"].combine_chunks())
+
+
+def lists_to_tuples(raw_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Necessary conversion to tuples, which is hashable type needed for grouping.
+    """
+    for col in ["funder", "affiliation_country", "data_tags"]:
+        raw_data[col] = [tuple(x) for x in raw_data[col]]
+    return raw_data
+
+
+def read_processed_data(path: Path) -> pd.DataFrame:
+    """
+    Reads the snapshot written by write_processed_data. It is memory mapped,
+    so the scalar columns are not decoded again, but Feather round-trips the
+    tuples as arrays, and restoring them (lists_to_tuples) is still a Python
+    loop over the rows on every load.
+    """
+    raw_data = feather.read_table(path, memory_map=True).to_pandas(
+        self_destruct=True, split_blocks=True
+    )
+    return lists_to_tuples(raw_data)
+
+
+def write_processed_data(raw_data: pd.DataFrame, path: Path) -> None:
+    # Uncompressed, as compressed buffers would have to be decompressed
+    # into memory anyway, defeating the memory map in read_processed_data.
+    feather.write_feather(raw_data, path, compression="uncompressed")
+
+
+def parquet_dataset(path: str) -> ds.Dataset:
+    return ds.dataset(
+        path,
+        format=ds.ParquetFileFormat(
+            # Stream the column chunks rather than pre-buffering them,
+            # which keeps the peak memory down.
+            default_fragment_scan_options=ds.ParquetFragmentScanOptions(
+                use_buffered_stream=True, pre_buffer=False
+            )
+        ),
+    )
+
+
+def write_parquet(
+    tables: Iterable[pa.Table], path: str, row_group_size: int = 100_000
+) -> None:
+    """
+    Writes the tables to a parquet file as they come, so that only about one
+    row group of them is held in memory at a time. The small tables are
+    gathered into row groups of row_group_size rows, to keep the file quick
+    to scan. The file is written next to path and only moved there once
+    complete.
+    """
+    tmp_path = Path(path).with_suffix(".tmp")
+    writer = None
+    pending, pending_rows = [], 0
+    try:
+        for table in tables:
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema, compression="snappy")
+            pending.append(table)
+            pending_rows += table.num_rows
+            if pending_rows >= row_group_size:
+                writer.write_table(pa.concat_tables(pending))
+                pending, pending_rows = [], 0
+        if writer is None:
+            raise ValueError("Matches generator is empty")
+        if pending:
+            writer.write_table(pa.concat_tables(pending))
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        tmp_path.unlink(missing_ok=True)
+        raise
+    writer.close()
+    tmp_path.replace(path)
+
+
+def load_data() -> pd.DataFrame:
     local_path = os.environ.get("LOCAL_DATA_PATH")
-    if local_path is not None and Path(local_path).exists():
-        dset = ds.dataset(local_path, format="parquet")
-    else:
+    processed_path = processed_data_path(local_path)
+    # The snapshot is only valid if it is not older than the parquet data.
+    # Without the parquet, it is rebuilt along with it.
+    if (
+        processed_path is not None
+        and processed_path.exists()
+        and Path(local_path).exists()
+        and processed_path.stat().st_mtime >= Path(local_path).stat().st_mtime
+    ):
+        return read_processed_data(processed_path)
+
+    if local_path is None:
         dset = ds.dataset(osh.matches_to_table(osh.get_data_from_mongo()))
-        pq.write_table(dset.to_table(), local_path, compression="snappy")
+    else:
+        if not Path(local_path).exists():
+            write_parquet(osh.matches_to_tables(osh.get_data_from_mongo()), local_path)
+        dset = parquet_dataset(local_path)
 
-    tb = dset.to_table()
+    tb = dset.to_table(columns=DATA_COLUMNS, filter=DATA_FILTER)
     split_col = pc.split_pattern(
         pc.if_else(
             pc.is_null(tb["affiliation_country"]),
@@ -35,26 +206,22 @@ def load_data():
         "affiliation_country",
         pa.array(split_col, type=pa.list_(pa.string())),
     )
-    raw_data = tb.to_pandas()
+    for col in ["funder", "affiliation_country", "data_tags"]:
+        tb = tb.set_column(tb.column_names.index(col), col, clean_list_column(tb[col]))
+    # Release the Arrow buffers as the columns are converted, to roughly
+    # halve the peak memory. tb must not be used after this.
+    raw_data = tb.to_pandas(self_destruct=True, split_blocks=True)
+    del tb
     raw_data["metrics"] = "RTransparent"
-    raw_data = raw_data[raw_data.year >= 2000]
+    raw_data = lists_to_tuples(raw_data)
 
-    # necessary conversion to tuples, which is hashable type
-    # needed for grouping.
-    # Also removes duplicates and removes leading and trailing spaces in values.
-    # Also replaces empty lists with ("None", ) to simplify the filtering and grouping in the dashboard
-    for col in ["funder", "affiliation_country", "data_tags"]:
-        raw_data[col] = raw_data[col].apply(
-            lambda x: ("None",)
-            if (len(x) == 0 or len(x) == 1 and x[0] == "")
-            else tuple(set([v.strip() for v in x]))
-        )
+    # Categorical encoding of the repeated string columns,
+    # to shrink memory and speed up the grouping in the dashboard.
+    # (strings in the tuple columns are already deduplicated by to_pandas)
+    raw_data["journal"] = raw_data["journal"].astype("category")
 
-    # Filter out some distracting weird data
-    raw_data = raw_data[
-        raw_data["journal"]
-        != "Acta Crystallographica Section E: Structure Reports Online"
-    ]
+    if processed_path is not None:
+        write_processed_data(raw_data, processed_path)
 
     return raw_data
 
@@ -1,8 +1,10 @@
 import json
+from collections.abc import Iterable
 from datetime import datetime
 from functools import lru_cache
 
 import colorcet as cc
+import numpy as np
 import pandas as pd
 import panel as pn
 import param
@@ -65,6 +67,62 @@ metrics_titles = {
 metrics_by_title = {v: k for k, v in metrics_titles.items()}
 
 
+# Parts of the ECharts config which don't depend on the data
+base_echarts_config = {
+    "grid": {
+        "width": "800",
+    },
+    "tooltip": {
+        "show": True,
+        "trigger": "axis",
+        "order": "valueDesc",
+        # "formatter": f"""<b>{self.splitting_var}</b> : {{b0}} <br />
+        #                 {{a0}} : {{c0}} <br />
+        #                 {{a1}} : {{c1}} """,
+    },
+    "legend": {
+        "type": "scroll",
+        "orient": "vertical",
+        "show": True,
+        "right": "0",
+        "textStyle": {"width": "250", "overflow": "break"},
+    },
+    "xAxis": {
+        "name": "year",
+        "nameLocation": "center",
+        "nameGap": 40,
+        "nameTextStyle": {
+            "fontWeight": "bold",
+            "fontFamily": "Roboto",
+            "fontSize": "20",
+        },
+    },
+    "yAxis": {
+        "nameLocation": "center",
+        "nameGap": 80,
+        "nameTextStyle": {
+            "fontWeight": "bold",
+            "fontFamily": "Roboto",
+            "fontSize": "20",
+        },
+    },
+}
+
+
+def merge_echarts_config(base: dict, update: dict) -> dict:
+    """
+    Recursively merges the update into a copy of the base config,
+    the same way ECharts merges options for nested dicts.
+    """
+    merged = dict(base)
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_echarts_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
 aggregation_formulas = {
     "percent": lambda x: x.mean() * 100,
     "count_true": lambda x: (x == True).sum(),  # noqa
@@ -73,6 +131,56 @@ aggregation_formulas = {
 }
 
 
+named_aggregations = {
+    f"{agg}_{field}": (field, aggregation_formulas[agg])
+    for field, aggs in dims_aggregations.items()
+    for agg in aggs
+}
+
+list_columns = ["affiliation_country", "funder", "data_tags"]
+
+filters_by_column = {
+    "journal": "filter_journal",
+    "affiliation_country": "filter_affiliation_country",
+    "funder": "filter_funder",
+    "data_tags": "filter_tags",
+}
+
+
+# Row positions, value codes and unique values, see flatten_list_column
+FlatListColumn = tuple[np.ndarray, np.ndarray, pd.Index]
+
+
+def flatten_list_column(col: pd.Series) -> FlatListColumn:
+    """
+    Flat layout of a column of tuples: the row position of every value,
+    and the values encoded as integer codes.
+    Empty cells are mapped to "None", as in the SelectPicker.
+    """
+    lengths = col.map(len).to_numpy(dtype=np.int64)
+    # Empty tuples are exploded to a single missing value
+    rows = np.repeat(np.arange(len(col)), lengths.clip(min=1))
+    values = col.explode()
+    is_empty_cell = values.isna() | (
+        values.eq("") & np.repeat(lengths == 1, lengths.clip(min=1))
+    )
+    codes, uniques = pd.factorize(values.mask(is_empty_cell, "None"))
+    return rows, codes, uniques
+
+
+def list_column_mask(flat_col: FlatListColumn, selected: Iterable[str]) -> np.ndarray:
+    """
+    Boolean mask of the rows containing at least one of the selected values.
+    """
+    rows, codes, uniques = flat_col
+    selected_codes = uniques.get_indexer(list(selected))
+    hits = np.isin(codes, selected_codes[selected_codes >= 0])
+    # Every row has at least one entry, empty cells included, so the last
+    # entry is in the last row.
+    n_rows = rows[-1] + 1 if len(rows) else 0
+    return np.bincount(rows[hits], minlength=n_rows).astype(bool)
+
+
 class MainDashboard(param.Parameterized):
     """
     Main dashboard for the application.
@@ -133,6 +241,13 @@ class MainDashboard(param.Parameterized):
 
         self.datasets = datasets
 
+        # frozenset versions of the filters values, see filter_set
+        self._filter_sets = {}
+
+        # Latest partial ECharts config, see echarts_config_updated
+        self._echarts_update = None
+        self._echarts_displayed = False
+
         # By default, take the first dataset.
         # Currently, there's only RTransparent
         self.param.extraction_tool.objects = [
@@ -200,6 +315,15 @@ class MainDashboard(param.Parameterized):
         # Update the raw data
         self.raw_data = self.datasets[self.extraction_tool]
 
+        # Flat layout of the list columns, used to filter on them
+        # with a vectorized mask instead of a Python callable per row.
+        self._flat_list_columns = {
+            col: flatten_list_column(self.raw_data[col]) for col in list_columns
+        }
+
+        # Aggregations of the unfiltered data, see grouped_data
+        self._grouped_data_cache = {}
+
         # Updated the metrics param
         new_extraction_tools_metrics = extraction_tools_params[self.extraction_tool][
             "metrics"
@@ -279,16 +403,9 @@ class MainDashboard(param.Parameterized):
         self.splitting_var = self.param.splitting_var.objects[0]
 
     @lru_cache
-    def get_col_values_with_count(self, col, none_test=lambda row: "None" in row):
-        values = {}
-        for row in self.raw_data[col].values:
-            if none_test(row):
-                ## Keeping "None" as a string on purpose, to represent it in the SelectPicker
-                values["None"] = values.get("None", 0) + 1
-            else:
-                for c in row:
-                    values[c] = values.get(c, 0) + 1
-        return values
+    def get_col_values_with_count(self, col):
+        ## Keeping "None" as a string on purpose, to represent it in the SelectPicker
+        return self.raw_data[col].explode().fillna("None").value_counts().to_dict()
 
     @pn.depends("splitting_var", watch=True)
     def did_change_splitting_var(self):
@@ -396,69 +513,94 @@ class MainDashboard(param.Parameterized):
         if notif_msg is not None:
             pn.state.notifications.info(notif_msg, duration=5000)
 
-    def filtered_grouped_data(self):
-        print("FILTERED_GROUPED_DATA")
-
-        filters = []
-
-        if len(self.filter_journal) != self.param.filter_journal.objects:
-            filters.append(f"journal in {self.filter_journal}")
+    def filter_set(self, filter_name: str) -> frozenset:
+        """
+        frozenset of the values of a ListSelector filter, for O(1) membership
+        tests. Only rebuilt when the filter is assigned a new list.
+        """
+        values = getattr(self, filter_name)
+        cached = self._filter_sets.get(filter_name)
+        if cached is None or cached[0] is not values:
+            cached = (values, frozenset(values))
+            self._filter_sets[filter_name] = cached
+        return cached[1]
+
+    def active_filters(self) -> dict[str, frozenset]:
+        """
+        Selected values of the filters restricting the data, by column.
+        """
+        filters = {}
+        for col, filter_name in filters_by_column.items():
+            if len(getattr(self, filter_name)) != len(self.param[filter_name].objects):
+                filters[col] = self.filter_set(filter_name)
+        return filters
+
+    def filter_mask(
+        self,
+        df: pd.DataFrame,
+        filters: dict[str, frozenset],
+        flat_list_columns: dict[str, FlatListColumn],
+    ) -> pd.Series:
+        """
+        Boolean mask of the rows of df matching the publication date and filters.
+        """
+        mask = pd.Series(True, index=df.index)
 
         if self.filter_pubdate is not None:
-            filters.append(f"year >= {self.filter_pubdate[0]}")
-            filters.append(f"year <= {self.filter_pubdate[1]}")
+            mask &= df.year.between(*self.filter_pubdate)
 
-        filtered_df = (
-            self.raw_data.query(" and ".join(filters)) if filters else self.raw_data
-        )
+        for col, selected in filters.items():
+            if col in list_columns:
+                # the filters on countries, funders and tags are a bit different
+                # as the rows are list of values
+                mask &= list_column_mask(flat_list_columns[col], selected)
+            else:
+                mask &= df[col].isin(selected)
+
+        return mask
+
+    def grouped_data(self, groupers: tuple[str, ...]) -> pd.DataFrame:
+        """
+        Aggregations of the unfiltered data, memoized per groupers.
+        """
+        if groupers not in self._grouped_data_cache:
+            self._grouped_data_cache[groupers] = (
+                self.raw_data.groupby(list(groupers), observed=True)
+                .agg(**named_aggregations)
+                .reset_index()
+            )
+        return self._grouped_data_cache[groupers]
 
-        if len(self.filter_affiliation_country) != len(
-            self.param.filter_affiliation_country.objects
-        ):
-            # the filter on countries is a bit different as the rows
-            # are list of countries
-            def country_filter(cell):
-                if len(cell) == 0 or len(cell) == 1 and cell[0] == "":
-                    return "None" in self.filter_affiliation_country
-                return any(c in self.filter_affiliation_country for c in cell)
-
-            filtered_df = filtered_df[
-                filtered_df.affiliation_country.apply(country_filter)
-            ]
-            print("FILTERED_GROUPED_DATA_COUNTRY", len(filtered_df))
-
-        if len(filtered_df) > 0 and len(self.filter_funder) != len(
-            self.param.filter_funder.objects
-        ):
-            # the filter on funders is similar to the filter on countries
-            def funder_filter(cell):
-                if len(cell) == 0 or len(cell) == 1 and cell[0] == "":
-                    return "None" in self.filter_funder
-                return any(c in self.filter_funder for c in cell)
-
-            filtered_df = filtered_df[filtered_df.funder.apply(funder_filter)]
-
-        if len(filtered_df) > 0 and len(self.filter_tags) != len(
-            self.param.filter_tags.objects
-        ):
-            # the filter on tags is similar to the filter on countries
-            def tags_filter(cell):
-                if len(cell) == 0 or len(cell) == 1 and cell[0] == "":
-                    return "None" in self.filter_tags
-                return any(c in self.filter_tags for c in cell)
-
-            filtered_df = filtered_df[filtered_df.data_tags.apply(tags_filter)]
-
-        aggregations = {}
-        for field, aggs in dims_aggregations.items():
-            for agg in aggs:
-                aggregations[f"{agg}_{field}"] = (field, aggregation_formulas[agg])
-
-        groupers = ["year"]
-        if self.splitting_var != "None":
-            groupers.append(self.splitting_var_from_label(self.splitting_var))
+    def filtered_grouped_data(self):
+        print("FILTERED_GROUPED_DATA")
 
-        result = filtered_df.groupby(groupers).agg(**aggregations).reset_index()
+        groupers = ("year",)
+        if self.splitting_var != "None":
+            groupers += (self.splitting_var_from_label(self.splitting_var),)
+
+        filters = self.active_filters()
+
+        if set(filters) <= set(groupers):
+            # Every filter is on a grouping column, so filtering the groups
+            # of the unfiltered data is the same as grouping the filtered data.
+            grouped = self.grouped_data(groupers)
+            flat_list_columns = {
+                col: flatten_list_column(grouped[col])
+                for col in filters
+                if col in list_columns
+            }
+            result = grouped[
+                self.filter_mask(grouped, filters, flat_list_columns)
+            ].reset_index(drop=True)
+        else:
+            filtered_df = self.raw_data[
+                self.filter_mask(self.raw_data, filters, self._flat_list_columns)
+            ]
+            result = (
+                filtered_df.groupby(list(groupers), observed=True)
+                .agg(**named_aggregations)
+                .reset_index()
+            )
 
         print("FILTERED_GROUPED_DATA_DONE", len(result))
 
@@ -513,69 +655,63 @@ class MainDashboard(param.Parameterized):
             splitting_var = self.splitting_var_from_label(self.splitting_var)
 
             if splitting_var == "affiliation_country":
-                splitting_var_filter = self.filter_affiliation_country
+                splitting_var_filter = self.filter_set("filter_affiliation_country")
                 splitting_var_column = "affiliation_country"
-                splitting_var_query = lambda cell, selected_item: selected_item in cell  # noqa: E731
+                splitting_var_is_list = True
 
             elif splitting_var == "funder":
-                splitting_var_filter = self.filter_funder
+                splitting_var_filter = self.filter_set("filter_funder")
                 splitting_var_column = "funder"
-                splitting_var_query = lambda cell, selected_item: selected_item in cell  # noqa: E731
+                splitting_var_is_list = True
 
             elif splitting_var == "data_tags":
-                splitting_var_filter = self.filter_tags
+                splitting_var_filter = self.filter_set("filter_tags")
                 splitting_var_column = "data_tags"
-                splitting_var_query = lambda cell, selected_item: selected_item in cell  # noqa: E731
+                splitting_var_is_list = True
 
             else:
                 print("Defaulting to splitting var 'journal' ")
-                splitting_var_filter = self.filter_journal
+                splitting_var_filter = self.filter_set("filter_journal")
                 splitting_var_column = "journal"
-                splitting_var_query = lambda cell, selected_item: cell == selected_item  # noqa: E731
+                splitting_var_is_list = False
+
+            # One row per (year, selected item), the list columns being exploded
+            # so that a row counts for every item its cell contains.
+            sub_df = df[["year", raw_metric, splitting_var_column]]
+            if splitting_var_is_list:
+                sub_df = sub_df.explode(splitting_var_column)
+            sub_df = sub_df[sub_df[splitting_var_column].isin(splitting_var_filter)]
+
+            aggregation = "mean" if "percent" in raw_metric else "sum"
+            grouped = sub_df.groupby([splitting_var_column, "year"], observed=True)[
+                raw_metric
+            ].agg(aggregation)
 
             last_year_values = {}
-            for selected_item in sorted(splitting_var_filter):
-                # sub_df = df.query(f"{splitting_var_column} == '{selected_item}'")
-
-                sub_df = df[
-                    df[splitting_var_column].apply(
-                        lambda x: splitting_var_query(x, selected_item)
-                    )
-                ]
-
-                if len(sub_df) > 0:
-                    aggregation = "mean" if "percent" in raw_metric else "sum"
-                    sub_df = (
-                        sub_df.groupby("year")
-                        .agg({raw_metric: aggregation})
-                        .reset_index()
-                    )
-
-                    value_last_year = sub_df[sub_df.year == sub_df.year.max()][
-                        raw_metric
-                    ].values[0]
-                    last_year_values[selected_item] = value_last_year
-
-                    series.append(
-                        {
-                            "id": selected_item,
-                            "name": selected_item,
-                            "type": "line",
-                            "data": sub_df[raw_metric].tolist(),
-                            # Shows a label at the end of the plotted line.
-                            # Labels end up overlapping in some cases.
-                            # To fix this, we would need to change the offset of the label
-                            # with values calculated to avoid overlapping.
-                            # https://echarts.apache.org/en/option.html#series-line.endLabel.offset
-                            # "endLabel":{
-                            #     "formatter":selected_item,
-                            #     "show":True,
-                            # }
-                        }
-                    )
-                    legend_data.append(
-                        {"name": selected_item, "icon": "path://M 0 0 H 20 V 20 H 0 Z"}
-                    )
+            for selected_item, item_values in grouped.groupby(level=0, observed=True):
+                # Years are sorted, so the last value is the one of the last year
+                last_year_values[selected_item] = item_values.iloc[-1]
+
+                series.append(
+                    {
+                        "id": selected_item,
+                        "name": selected_item,
+                        "type": "line",
+                        "data": item_values.tolist(),
+                        # Shows a label at the end of the plotted line.
+                        # Labels end up overlapping in some cases.
+                        # To fix this, we would need to change the offset of the label
+                        # with values calculated to avoid overlapping.
+                        # https://echarts.apache.org/en/option.html#series-line.endLabel.offset
+                        # "endLabel":{
+                        #     "formatter":selected_item,
+                        #     "show":True,
+                        # }
+                    }
+                )
+                legend_data.append(
+                    {"name": selected_item, "icon": "path://M 0 0 H 20 V 20 H 0 Z"}
+                )
 
             # Sort the legend series by decreasing order of the last year value
             legend_data.sort(
@@ -596,50 +732,21 @@ class MainDashboard(param.Parameterized):
         # ["#5470c6", "#91cc75", "#fac858", "#ee6666", "#73c0de", "#3ba272", "#fc8452", "#9a60b4", "#ea7ccc"]
         # https://echarts.apache.org/en/option.html#color
 
-        echarts_config = {
+        # Only the parts of the config that depend on the data and the selection.
+        # The static parts are in base_echarts_config.
+        echarts_update = {
             "color": colormap,
             "title": {
                 "text": title,
             },
-            "grid": {
-                "width": "800",
-            },
-            "tooltip": {
-                "show": True,
-                "trigger": "axis",
-                "order": "valueDesc",
-                # "formatter": f"""<b>{self.splitting_var}</b> : {{b0}} <br />
-                #                 {{a0}} : {{c0}} <br />
-                #                 {{a1}} : {{c1}} """,
-            },
             "legend": {
                 "data": legend_data,
-                "type": "scroll",
-                "orient": "vertical",
-                "show": True,
-                "right": "0",
-                "textStyle": {"width": "250", "overflow": "break"},
             },
             "xAxis": {
                 "data": xAxis,
-                "name": "year",
-                "nameLocation": "center",
-                "nameGap": 40,
-                "nameTextStyle": {
-                    "fontWeight": "bold",
-                    "fontFamily": "Roboto",
-                    "fontSize": "20",
-                },
             },
             "yAxis": {
                 "name": self.metrics,
-                "nameLocation": "center",
-                "nameGap": 80,
-                "nameTextStyle": {
-                    "fontWeight": "bold",
-                    "fontFamily": "Roboto",
-                    "fontSize": "20",
-                },
                 "axisLabel": {
                     "formatter": "{value}%" if "percent" in raw_metric else "{value}"
                 },
@@ -647,14 +754,22 @@ class MainDashboard(param.Parameterized):
             "series": series,
         }
 
-        self.echarts_config = echarts_config
+        self._echarts_update = echarts_update
+        self.echarts_config = merge_echarts_config(base_echarts_config, echarts_update)
         self.echarts_config_editor.value = json.dumps(
             self.echarts_config, indent=4, sort_keys=True
         )
 
     @pn.depends("echarts_config", watch=True)
     def echarts_config_updated(self):
-        self.echarts_pane.object = self.echarts_config
+        echarts_update, self._echarts_update = self._echarts_update, None
+        if self._echarts_displayed and echarts_update is not None:
+            # The displayed chart already has the base config, ECharts merges
+            # the update into it (replacing the series, see echarts_pane options)
+            # so there is no need to send the whole config.
+            self.echarts_pane.object = echarts_update
+        else:
+            self.echarts_pane.object = self.echarts_config
         self.echarts_pane.loading = False
 
     def did_click_update_echart_plot(self, event):
@@ -824,6 +939,11 @@ class MainDashboard(param.Parameterized):
     def get_dashboard(self):
         print("GET_DASHBOARD")
 
+        # New views of the pane are rendered from its object,
+        # which must be the whole config, not the latest update.
+        self.echarts_pane.object = self.echarts_config
+        self._echarts_displayed = True
+
         items = [
             self.get_top_bar(),
             divider(),